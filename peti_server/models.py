@@ -5,20 +5,41 @@ Contains the configuration and sync folder classes for the sync server.
 """
 import json
 import logging
+import os
 import sys
+import tempfile
+from collections import OrderedDict
 from enum import Enum
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
 
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
 
-# API URL templates with named placeholders
-API_URL_BASE = "http://{host}/api?method={method}"
-API_FOLDER_URL = API_URL_BASE + "&dir={dir}&secret={secret}&{options}"
-API_SIMPLE_URL = API_URL_BASE + "&dir={dir}&{options}"
+# API URL template with named placeholders
+API_URL_BASE = "http://{host}/api"
 
 MAX_WAIT_SECONDS = 120
 RETRY_INTERVAL_SECONDS = 10
+# Connect and read timeout of a single HTTP request
+REQUEST_TIMEOUT_SECONDS = (5, 60)
+
+# Locations of the games database
+ETI_LAUNCHER_DATABASE_PATH = "eti_launcher/update/game.db"
+LOCAL_DB_NAME = "game.db"
+# Folder preferences applied in earlier runs
+PREFS_STATE_NAME = "folder_prefs.json"
+
+# Upper bound of concurrent requests against the Resilio API
+MAX_PARALLEL_REQUESTS = 64
+
+# Prefer the libyaml C bindings for parsing, if available
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parsed configurations keyed by (path, mtime, size) of the config file
+_CONFIG_CACHE: OrderedDict = OrderedDict()
+_CONFIG_CACHE_SIZE = 16
 
 
 class ApiMethod(Enum):
@@ -29,6 +50,23 @@ class ApiMethod(Enum):
     SHUTDOWN = 'shutdown'
 
 
+# Log wording of the processed API methods
+_ACTION_BY_METHOD = {
+    ApiMethod.REMOVE_FOLDER: "removed",
+    ApiMethod.ADD_FOLDER: "added or updated",
+    ApiMethod.SET_FOLDER_PREFS: "preferences updated",
+}
+
+# Readable messages for some of the API error codes
+_ERROR_MESSAGES = {
+    3: "Folder is not known",
+}
+
+# Error of add_folder for a folder which is already added.
+# Assumed value, not verified against a Resilio Sync server.
+FOLDER_ALREADY_ADDED_ERROR = 105
+
+
 class Configuration:
     """
     Object-oriented wrapper for the configuration data.
@@ -43,40 +81,40 @@ class Configuration:
         self._yaml = self._config.get('_yaml', {})
         self.keep_discarded_games = keep_discarded_games
 
-    @property
-    def user(self) -> str:
-        """Get authentication username"""
-        return self._config.get('resilio_auth', {}).get('user', '')
-
-    @property
-    def password(self) -> str:
-        """Get authentication password"""
-        return self._config.get('resilio_auth', {}).get('password', '')
-
-    @property
-    def host(self) -> str:
-        """Get Resilio host and port"""
-        return self._config.get('resilio_host', 'localhost:8080')
-
-    @property
-    def sync_dir(self) -> str:
-        """Get synchronization directory path"""
-        return self._config.get('resilio_sync_dir', '')
-
-    @property
-    def data_dir(self) -> str:
-        """Get data directory path"""
-        return self._config.get('data_dir', '')
-
-    @property
-    def sync_options(self) -> str:
-        """Get synchronization options"""
-        return self._config.get('resilio_sync_options', '')
-
-    @property
-    def game_deny_list(self) -> list:
-        """Gibt die Spiele-Denylist aus der Konfiguration zurück"""
-        return self._yaml.get('games', {}).get('denylist', [])
+        # Resolve the settings once, they are read for every API request
+        resilio_auth = self._config.get('resilio_auth', {})
+        self.user: str = resilio_auth.get('user', '')
+        self.password: str = resilio_auth.get('password', '')
+        self.host: str = self._config.get('resilio_host', 'localhost:8080')
+        self.sync_dir: str = self._config.get('resilio_sync_dir', '')
+        self.data_dir: str = self._config.get('data_dir', '')
+        self.sync_options: str = self._config.get('resilio_sync_options', '')
+        self.game_deny_list: frozenset = frozenset(
+            self._yaml.get('games', {}).get('denylist', []))
+
+        # Local games database and the update delivered by the launcher folder
+        self.db_path: str = os.path.join(self.data_dir, LOCAL_DB_NAME)
+        self.new_db_path: str = os.path.join(self.sync_dir,
+                                             ETI_LAUNCHER_DATABASE_PATH)
+        self.prefs_state_path: str = os.path.join(self.data_dir,
+                                                  PREFS_STATE_NAME)
+
+        # Parts of the API URLs which are the same for every request
+        self.api_url: str = API_URL_BASE.format(host=self.host)
+        self.sync_params: list = parse_qsl(self.sync_options,
+                                           keep_blank_values=True)
+
+        # Shared HTTP session to reuse connections to the Resilio API
+        self.session = requests.Session()
+        self.session.auth = (self.user, self.password)
+        self.session.mount(
+            "http://",
+            HTTPAdapter(pool_connections=1,
+                        pool_maxsize=MAX_PARALLEL_REQUESTS))
+
+    def close(self) -> None:
+        """Close the connections to the Resilio API"""
+        self.session.close()
 
     def get_folders(self) -> Dict[str, Dict[str, str]]:
         """Get all folder configurations"""
@@ -88,6 +126,8 @@ class SyncFolder:
     Represents a folder to be synchronized with the sync server.
     """
 
+    __slots__ = ("config", "name", "id", "secret", "last_error")
+
     def __init__(self,
                  config: Configuration,
                  folder_name: str,
@@ -105,7 +145,10 @@ class SyncFolder:
         self.config = config
         self.name = folder_name
         self.id = folder_id or folder_name
-        self.secret = secret or self._get_secret_from_config(folder_name)
+        self.secret = (secret if secret is not None else
+                       self._get_secret_from_config(folder_name))
+        # API error code of the last request, None if it failed
+        self.last_error: Optional[int] = None
 
     def _get_secret_from_config(self, folder_name: str) -> str:
         """Get the secret key for a folder from configuration"""
@@ -124,6 +167,28 @@ class SyncFolder:
         """Remove this folder from the sync system"""
         return self._make_sync_request(ApiMethod.REMOVE_FOLDER, force=True)
 
+    def api_params(self,
+                   method: ApiMethod,
+                   force: bool = False) -> List[Tuple[str, str]]:
+        """
+        Get the query parameters of an API request for this folder
+
+        Args:
+            method: API method to use
+            force: Whether to add force=1 parameter
+
+        Returns:
+            list: Query parameters as key and value pairs
+        """
+        params = [('method', method.value),
+                  ('dir', f"{self.config.sync_dir}/{self.id}")]
+        if self.secret:
+            params.append(('secret', self.secret))
+        params += self.config.sync_params
+        if force:
+            params.append(('force', '1'))
+        return params
+
     def __repr__(self):
         """String representation of the sync folder"""
         return f"SyncFolder(name={self.name}, id={self.id})"
@@ -138,33 +203,21 @@ class SyncFolder:
             method: API method to use
             force: Whether to add force=1 parameter
 
+        The error code of the API is kept in last_error.
+
         Returns:
             bool: True if successful, False if failed
         """
+        self.last_error = None
         try:
-            if self.secret:
-                url = API_FOLDER_URL.format(
-                    host=self.config.host,
-                    method=method.value,
-                    dir=f"{self.config.sync_dir}/{self.id}",
-                    secret=self.secret,
-                    options=self.config.sync_options)
-            else:
-                url = API_SIMPLE_URL.format(
-                    host=self.config.host,
-                    method=method.value,
-                    dir=f"{self.config.sync_dir}/{self.id}",
-                    options=self.config.sync_options)
-
-            if force:
-                url += "&force=1"
+            url = (f"{self.config.api_url}?"
+                   f"{urlencode(self.api_params(method, force))}")
             import time
             start_time = time.time()
             while True:
                 try:
-                    response = requests.get(url,
-                                            auth=(self.config.user,
-                                                  self.config.password))
+                    response = self.config.session.get(
+                        url, timeout=REQUEST_TIMEOUT_SECONDS)
                     response.raise_for_status()
                     break
                 except requests.exceptions.ConnectionError as e:
@@ -178,28 +231,22 @@ class SyncFolder:
                     time.sleep(RETRY_INTERVAL_SECONDS)
                 except Exception:
                     raise
-            if method == ApiMethod.REMOVE_FOLDER:
-                action = "removed"
-            elif method == ApiMethod.ADD_FOLDER:
-                action = "added or updated"
-            elif method == ApiMethod.SET_FOLDER_PREFS:
-                action = "preferences updated"
-            else:
-                action = "processed (unknown method)"
+            action = _ACTION_BY_METHOD.get(method,
+                                           "processed (unknown method)")
 
             json_response = response.json()
             sync_message = json_response.get('message', '')
             sync_error: int = json_response.get('error', 0)
 
             # Map some error codes to more readable messages
-            if sync_error == 3:
-                sync_message = "Folder is not known"
+            sync_message = _ERROR_MESSAGES.get(sync_error, sync_message)
 
             log_message = f"[{self.name}|{self.id}] {action}"
             if sync_error != 0:
                 log_message += f": '{sync_message}' ({sync_error})"
             logging.info(log_message)
-            return True
+            self.last_error = sync_error
+            return sync_error == 0
 
         except requests.exceptions.RequestException as e:
             logging.error(f"Error processing folder '{self.name}': {e}")
@@ -217,8 +264,20 @@ def load_config(config_path: str = "/root/eti-config.yaml") -> dict:
         dict: Configuration dictionary preserving the original structure
     """
     try:
-        with open(config_path, 'r') as file:
-            config_yaml = yaml.safe_load(file)
+        # Reuse an earlier parse as long as the file is unchanged.
+        # The Configuration only reads the dict, so no copy is handed out.
+        stat = os.stat(config_path)
+        cache_key = (os.path.abspath(config_path), stat.st_mtime_ns,
+                     stat.st_size)
+        if cache_key in _CONFIG_CACHE:
+            _CONFIG_CACHE.move_to_end(cache_key)
+            return _CONFIG_CACHE[cache_key]
+
+        config_yaml = _load_config_sidecar(config_path, stat)
+        if config_yaml is None:
+            with open(config_path, 'r') as file:
+                config_yaml = yaml.load(file, Loader=_YAML_LOADER)
+            _write_config_sidecar(config_path, stat, config_yaml)
 
         # Store the original YAML structure
         config = {'_yaml': config_yaml}
@@ -228,6 +287,10 @@ def load_config(config_path: str = "/root/eti-config.yaml") -> dict:
             if key != '_yaml':
                 config[key] = value
 
+        _CONFIG_CACHE[cache_key] = config
+        if len(_CONFIG_CACHE) > _CONFIG_CACHE_SIZE:
+            _CONFIG_CACHE.popitem(last=False)
+
         return config
     except FileNotFoundError:
         logging.error(f"Configuration file not found: {config_path}")
@@ -238,3 +301,75 @@ def load_config(config_path: str = "/root/eti-config.yaml") -> dict:
     except Exception as e:
         logging.error(f"Error loading configuration: {e}")
         sys.exit(1)
+
+
+def write_json_atomic(path: str, data) -> None:
+    """
+    Write data as JSON to the given path, replacing the file atomically
+
+    Args:
+        path: Path of the JSON file
+        data: JSON serializable data to write
+    """
+    with tempfile.NamedTemporaryFile('w',
+                                     dir=os.path.dirname(path) or '.',
+                                     prefix=os.path.basename(path) + '.',
+                                     suffix='.tmp',
+                                     delete=False) as file:
+        try:
+            json.dump(data, file)
+        except Exception:
+            os.unlink(file.name)
+            raise
+    try:
+        os.replace(file.name, path)
+    except OSError:
+        os.unlink(file.name)
+        raise
+
+
+def _load_config_sidecar(config_path: str, stat: os.stat_result):
+    """
+    Load the parsed configuration from the JSON sidecar of the config file
+
+    Returns:
+        The parsed YAML structure, or None if the sidecar is missing or was
+        written for another version of the config file
+    """
+    try:
+        with open(config_path + ".json", 'r') as file:
+            sidecar = json.load(file)
+        if (sidecar.get('mtime_ns') != stat.st_mtime_ns
+                or sidecar.get('size') != stat.st_size):
+            return None
+        return sidecar['config']
+    except (OSError, ValueError, AttributeError, KeyError):
+        return None
+
+
+def _write_config_sidecar(config_path: str, stat: os.stat_result,
+                          config_yaml) -> None:
+    """Store the parsed configuration as JSON next to the config file"""
+    # JSON would turn other values like non-string keys into strings
+    if not _is_json_compatible(config_yaml):
+        return
+    try:
+        write_json_atomic(
+            config_path + ".json", {
+                'mtime_ns': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'config': config_yaml
+            })
+    except (OSError, TypeError, ValueError) as e:
+        logging.debug(f"Could not write configuration cache: {e}")
+
+
+def _is_json_compatible(data) -> bool:
+    """Check whether data is loaded back unchanged from JSON"""
+    if isinstance(data, dict):
+        return all(
+            isinstance(key, str) and _is_json_compatible(value)
+            for key, value in data.items())
+    if isinstance(data, list):
+        return all(_is_json_compatible(value) for value in data)
+    return data is None or isinstance(data, (str, int, float))
@@ -8,20 +8,35 @@ It handles starting, stopping, cleaning up, and updating synchronization keys.
 import argparse
 import concurrent
 import concurrent.futures
+import contextlib
+import hashlib
+import json
 import logging
 import os
 import shutil
 import sqlite3
-import tarfile
-from pathlib import Path
+from urllib.parse import quote, urlencode
 
 import requests
 
-from peti_server.models import (Configuration, SyncFolder)
+from peti_server.models import (LOCAL_DB_NAME, MAX_PARALLEL_REQUESTS,
+                                FOLDER_ALREADY_ADDED_ERROR,
+                                REQUEST_TIMEOUT_SECONDS, ApiMethod,
+                                Configuration, SyncFolder, write_json_atomic)
 
 ETI_SYNC_SERVER_DOWNLOAD_URL = "https://www.eti-lan.xyz/sync_server.tar"
-ETI_LAUNCHER_DATABASE_PATH = "eti_launcher/update/game.db"
-LOCAL_DB_NAME = "game.db"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+THREAD_NAME_PREFIX = "peti-sync"
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+# Games and tools to sync and discarded games to remove, in one result set
+SQL_ALL_FOLDERS = """
+    SELECT game_key, game_title, game_id, 'game' AS kind FROM games
+    UNION ALL
+    SELECT tool_key, tool_name, tool_id, 'tool' FROM tools
+    UNION ALL
+    SELECT game_key, game_id, game_id, 'discarded' FROM discarded
+"""
 
 
 def main():
@@ -45,10 +60,13 @@ def main():
 
     config = Configuration(args.config, args.keep_discarded_games)
 
-    if args.action == 'update':
-        update_game_folders(config)
-    elif args.action == 'cleanup':
-        cleanup(config)
+    try:
+        if args.action == 'update':
+            update_game_folders(config)
+        elif args.action == 'cleanup':
+            cleanup(config)
+    finally:
+        config.close()
 
 
 def update_game_folders(config: Configuration) -> None:
@@ -59,84 +77,73 @@ def update_game_folders(config: Configuration) -> None:
         config: Configuration object containing sync settings
     """
 
-    # Try to prepare the ETI database
-    try:
-        database = get_eti_database(config)
-    except FileNotFoundError:
-        logging.error(
-            "ETI Database file not found. Downloading initial database...")
-        download_initial_game_db(config)
-        database = get_eti_database(config)
-
     # Add the core system folders
     system_folders = []
     for folder_name, values in config.get_folders().items():
         system_folders.append(
             SyncFolder(config, folder_name, secret=values.get('secret', ''))),
 
-    logging.info("\n================================")
-    logging.info("Add/Update system tools...")
-    # Sync the system folders
-    for folder in system_folders:
-        folder.sync()
-
-    # Process all game folders
-    logging.info("\n================================")
-    logging.info("Prepare lists of games...")
-
-    allow_list = get_games_from_db(config, database)
-    deny_list = get_discarded_from_db(config, database)
-
-    denied_folder_ids = set(config.game_deny_list)
-    moved_to_deny = [
-        folder for folder in allow_list if folder.id in denied_folder_ids
-    ]
-    allow_list = [
-        folder for folder in allow_list if folder.id not in denied_folder_ids
-    ]
-    for folder in moved_to_deny:
-        logging.info(f"Move game {folder.name}|{folder.id} to deny list...")
-        deny_list.append(folder)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_PARALLEL_REQUESTS,
+            thread_name_prefix=THREAD_NAME_PREFIX) as executor:
+        logging.info("\n================================")
+        logging.info("Add/Update system tools...")
+        # Sync the system folders while the game lists are prepared
+        futures = [
+            executor.submit(sync_system_folder, folder)
+            for folder in system_folders
+        ]
 
-    logging.info(f"Found {len(allow_list)} allowed games to sync.")
-    logging.info(f"Found {len(deny_list)} games to remove if existing.")
+        # Try to prepare the ETI database
+        try:
+            database = get_eti_database(config)
+        except FileNotFoundError:
+            logging.error(
+                "ETI Database file not found. Downloading initial database...")
+            download_initial_game_db(config)
+            database = get_eti_database(config)
 
-    logging.info("\n================================")
-    logging.info("Synchronizing allowed games...")
-    with concurrent.futures.ThreadPoolExecutor() as executor:
+        # Process all game folders
+        logging.info("\n================================")
+        logging.info("Prepare lists of games...")
 
-        def process_folder(folder):
-            logging.info(f"[{folder.name}|{folder.id}] processing...")
-            folder.sync()
-            folder.update_prefs()
-            return folder.name
+        with contextlib.closing(connect_eti_database(database)) as conn:
+            allow_list, deny_list = load_all_folders(config, conn)
 
-        # Submit all folders for parallel processing
-        futures = [
-            executor.submit(process_folder, folder) for folder in allow_list
-        ]
+        kept = []
+        for folder in allow_list:
+            if folder.id in config.game_deny_list:
+                logging.info(
+                    f"Move game {folder.name}|{folder.id} to deny list...")
+                deny_list.append(folder)
+            else:
+                kept.append(folder)
+        allow_list = kept
 
-        # Wait for all tasks to complete
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                folder_name = future.result()
-                logging.debug(f"[{folder_name}] completed")
-            except Exception as e:
-                logging.error(f"Error processing: {e}")
+        logging.info(f"Found {len(allow_list)} allowed games to sync.")
+        logging.info(f"Found {len(deny_list)} games to remove if existing.")
 
-    if not config.keep_discarded_games:
         logging.info("\n================================")
-        logging.info("Removing denied games...")
+        logging.info("Synchronizing allowed games...")
+        applied_prefs = load_prefs_state(config)
+        current_prefs = {}
+        futures += [
+            executor.submit(sync_folder, folder, applied_prefs, current_prefs)
+            for folder in allow_list
+        ]
+        wait_for_folders(futures)
+        if current_prefs != applied_prefs:
+            save_prefs_state(config, current_prefs)
 
-        # Remove discarded folders
-        for folder in deny_list:
-            logging.info(f"Removing {folder.name} ({folder.secret})...")
-            folder.remove()
+        if not config.keep_discarded_games:
+            logging.info("\n================================")
+            logging.info("Removing denied games...")
 
-            # Remove local folder if it exists
-            folder_path = os.path.join(config.sync_dir, folder.id)
-            if os.path.exists(folder_path):
-                shutil.rmtree(folder_path)
+            # Remove discarded folders
+            wait_for_folders([
+                executor.submit(remove_folder, config, folder)
+                for folder in deny_list
+            ])
 
     logging.info("\n================================")
     logging.info("Games synchronized")
@@ -154,37 +161,150 @@ def cleanup(config: Configuration) -> None:
 
         # Remove all known game folders
         database = get_eti_database(config)
-        game_folders = get_games_from_db(config, database)
-        game_folders += get_discarded_from_db(config, database)
+        with contextlib.closing(connect_eti_database(database)) as conn:
+            allow_list, deny_list = load_all_folders(config, conn)
+        game_folders = allow_list + deny_list
+
+        # The removed folders need their preferences again once re-added
+        clear_prefs_state(config)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(MAX_PARALLEL_REQUESTS,
+                                max(4, len(game_folders))),
+                thread_name_prefix=THREAD_NAME_PREFIX) as executor:
+            wait_for_folders([
+                executor.submit(remove_folder, config, folder)
+                for folder in game_folders
+            ])
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
 
-            def process_folder(folder):
-                logging.info(f"[{folder.name}|{folder.id}] processing...")
-                folder.remove()
+def sync_system_folder(folder: SyncFolder) -> str:
+    """
+    Adds or updates a system folder in the sync system.
 
-                # Remove local folder if it exists
-                folder_path = os.path.join(config.sync_dir, folder.id)
-                if os.path.exists(folder_path):
-                    shutil.rmtree(folder_path)
-                return folder.name
+    Args:
+        folder: Folder to synchronize
 
-            # Submit all folders for parallel processing
-            futures = [
-                executor.submit(process_folder, folder)
-                for folder in game_folders
-            ]
+    Returns:
+        Name of the processed folder
+    """
+    folder.sync()
+    return folder.name
+
+
+def sync_folder(folder: SyncFolder, applied_prefs: dict,
+                current_prefs: dict) -> str:
+    """
+    Adds or updates a folder and its preferences in the sync system.
+    The preferences are only sent again if the folder was already added to
+    the sync system and they did not change since the last run.
+
+    Args:
+        folder: Folder to synchronize
+        applied_prefs: Preference digests per folder id of the last run
+        current_prefs: Preference digests per folder id of this run, the
+            folder is added once it is up to date
+
+    Returns:
+        Name of the processed folder
+    """
+    logging.info(f"[{folder.name}|{folder.id}] processing...")
+    folder.sync()
+    if folder.last_error is None:
+        return folder.name
+
+    digest = hashlib.sha256(
+        urlencode(folder.api_params(
+            ApiMethod.SET_FOLDER_PREFS)).encode()).hexdigest()
+    # Relies on FOLDER_ALREADY_ADDED_ERROR, which is an assumed error code.
+    # If Resilio answers differently, the preferences are sent every run.
+    already_added = folder.last_error == FOLDER_ALREADY_ADDED_ERROR
+    if already_added and applied_prefs.get(folder.id) == digest:
+        logging.debug(f"[{folder.name}|{folder.id}] preferences unchanged")
+        current_prefs[folder.id] = digest
+    elif folder.update_prefs():
+        current_prefs[folder.id] = digest
+    return folder.name
+
+
+def remove_folder(config: Configuration, folder: SyncFolder) -> str:
+    """
+    Removes a folder from the sync system and its local data.
+
+    Args:
+        config: Configuration object containing sync settings
+        folder: Folder to remove
+
+    Returns:
+        Name of the processed folder
+    """
+    logging.info(f"[{folder.name}|{folder.id}] processing...")
+    folder.remove()
+
+    # Remove local folder if it exists
+    shutil.rmtree(os.path.join(config.sync_dir, folder.id), ignore_errors=True)
+    return folder.name
+
+
+def wait_for_folders(futures: list) -> None:
+    """
+    Waits for all submitted folder tasks and logs their failures.
+
+    Args:
+        futures: Futures of the submitted folder tasks
+    """
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            folder_name = future.result()
+            logging.debug(f"[{folder_name}] completed")
+        except Exception as e:
+            logging.error(f"Error processing folder: {e}")
+
+
+def load_prefs_state(config: Configuration) -> dict:
+    """
+    Reads the folder preferences applied in earlier runs.
+
+    Args:
+        config: Configuration object containing sync settings
+
+    Returns:
+        Preference digests per folder id, empty if none are known
+    """
+    try:
+        with open(config.prefs_state_path, 'r') as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
 
-            # Wait for all tasks to complete
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    folder_name = future.result()
-                    logging.debug(f"[{folder_name}] completed")
-                except Exception as e:
-                    logging.error(f"Error processing folder: {e}")
 
+def save_prefs_state(config: Configuration, state: dict) -> None:
+    """
+    Stores the folder preferences applied in this run.
+
+    Args:
+        config: Configuration object containing sync settings
+        state: Preference digests per folder id
+    """
+    try:
+        write_json_atomic(config.prefs_state_path, state)
+    except OSError as e:
+        logging.error(f"Could not store folder preferences state: {e}")
+
+
+def clear_prefs_state(config: Configuration) -> None:
+    """
+    Forgets the folder preferences applied in earlier runs.
+
+    Args:
+        config: Configuration object containing sync settings
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(config.prefs_state_path)
 
-def get_eti_database(config: Configuration) -> Path:
+
+def get_eti_database(config: Configuration) -> str:
     """
     Returns the path to the ETI database file.
 
@@ -194,94 +314,89 @@ def get_eti_database(config: Configuration) -> Path:
     Returns:
         Path to the ETI database file
     """
-    db_path = Path(config.data_dir) / LOCAL_DB_NAME
-
     # Check for new database file in the sync directory
-    new_db_path = Path(config.sync_dir) / ETI_LAUNCHER_DATABASE_PATH
-    if new_db_path.exists():
-        logging.info(f"Updating database from download: {new_db_path}")
+    if os.path.exists(config.new_db_path) and not _is_same_file_version(
+            config.new_db_path, config.db_path):
+        logging.info(f"Updating database from download: {config.new_db_path}")
+        # Swap the database atomically, a partial copy must not be used
+        partial_db = config.db_path + ".tmp"
         try:
-            shutil.copy(new_db_path, db_path)
+            shutil.copyfile(config.new_db_path, partial_db)
+            # Keep the modification time to detect unchanged updates
+            new_db_stat = os.stat(config.new_db_path)
+            os.utime(partial_db,
+                     ns=(new_db_stat.st_atime_ns, new_db_stat.st_mtime_ns))
+            os.replace(partial_db, config.db_path)
         except IOError as e:
             logging.error(f"Could not copy updated games database: {e}")
+            with contextlib.suppress(OSError):
+                os.unlink(partial_db)
 
-    if not db_path.exists():
-        logging.error(f"ETI Database file not found: {db_path}")
-        raise FileNotFoundError(f"ETI Database file not found: {db_path}")
+    if not os.path.exists(config.db_path):
+        logging.error(f"ETI Database file not found: {config.db_path}")
+        raise FileNotFoundError(
+            f"ETI Database file not found: {config.db_path}")
 
-    return db_path
+    return config.db_path
 
 
-def get_games_from_db(config: Configuration, db_path: Path) -> list:
+def connect_eti_database(db_path: str) -> sqlite3.Connection:
     """
-    Retrieves game folders from the ETI database.
+    Opens a read-only connection to the ETI database.
 
     Args:
-        config: Configuration object containing sync settings
+        db_path: Path to the ETI database file
 
     Returns:
-        List of SyncFolder objects representing game folders
+        Connection to the ETI database
     """
-    game_folders = []
+    # The local copy is not changed while it is read
+    conn = sqlite3.connect(
+        f"file:{quote(os.path.abspath(db_path))}?mode=ro&immutable=1",
+        uri=True)
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    return conn
 
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        # Get games data
-        cursor.execute(
-            "SELECT game_key, game_title, game_id FROM games ORDER BY db_id")
-        for row in cursor.fetchall():
-            secret_key, title, folder_id = row
-            game_folders.append(
-                SyncFolder(config, title, folder_id, secret_key))
-
-        # Get tools data
-        cursor.execute(
-            "SELECT tool_key, tool_name, tool_id FROM tools ORDER BY db_id")
-        for row in cursor.fetchall():
-            secret_key, title, folder_id = row
-            game_folders.append(
-                SyncFolder(config, title, folder_id, secret_key))
-
-        conn.close()
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error during games and tool retrieval: {e}")
-        raise
 
-    return game_folders
+def _is_same_file_version(source: str, target: str) -> bool:
+    """Checks whether both files have the same size and modification time"""
+    try:
+        source_stat = os.stat(source)
+        target_stat = os.stat(target)
+    except OSError:
+        return False
+    return (source_stat.st_size == target_stat.st_size
+            and source_stat.st_mtime_ns == target_stat.st_mtime_ns)
 
 
-def get_discarded_from_db(config: Configuration, db_path: Path) -> list:
+def load_all_folders(config: Configuration, conn: sqlite3.Connection) -> tuple:
     """
-    Retrieves discarded game folders from the ETI database.
+    Retrieves the game, tool and discarded game folders from the ETI database.
 
     Args:
         config: Configuration object containing sync settings
+        conn: Connection to the ETI database
 
     Returns:
-        List of SyncFolder objects representing discarded game folders
+        Tuple of the SyncFolder lists for games and tools to sync, and for
+        discarded games to remove
     """
-    removed_folders = []
+    allow_list = []
+    deny_list = []
 
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        # Get discarded items for removal
-        cursor.execute(
-            "SELECT game_key, game_id FROM discarded ORDER BY del_id")
-        for row in cursor.fetchall():
-            secret_key, folder_id = row
-            removed_folders.append(
-                SyncFolder(config, folder_id, folder_id, secret_key))
-
-        conn.close()
+        for secret_key, title, folder_id, kind in conn.execute(
+                SQL_ALL_FOLDERS):
+            folder = SyncFolder(config, title, folder_id, secret_key)
+            if kind == 'discarded':
+                deny_list.append(folder)
+            else:
+                allow_list.append(folder)
     except sqlite3.Error as e:
-        logging.error(f"SQLite error during discarded retrieval: {e}")
+        logging.error(f"SQLite error during folder retrieval: {e}")
         raise
 
-    return removed_folders
+    return allow_list, deny_list
 
 
 def download_initial_game_db(config: Configuration) -> None:
@@ -291,33 +406,32 @@ def download_initial_game_db(config: Configuration) -> None:
     Args:
         config: Configuration object containing sync settings
     """
+    # Only needed for the rare first download
+    import tarfile
 
     logging.info("Downloading initial game database...")
 
+    downloaded_db = config.db_path
+    partial_db = downloaded_db + ".download"
     try:
-        response = requests.get(ETI_SYNC_SERVER_DOWNLOAD_URL,
-                                allow_redirects=True)
-        dl_path = Path(config.data_dir) / "download"
-        tar_path = dl_path / Path(ETI_SYNC_SERVER_DOWNLOAD_URL).name
-
-        # Write the tar file to disk
-        dl_path.mkdir(parents=True, exist_ok=True)
-        with open(tar_path, "wb") as f:
-            f.write(response.content)
-
-        # Extract games database
-        downloaded_db = Path(config.data_dir) / LOCAL_DB_NAME
-        with tarfile.open(tar_path, "r") as tar:
-            for member in tar.getmembers():
-                if member.name.endswith(LOCAL_DB_NAME):
-                    tar.extract(member, path=dl_path, filter='data')
-                    shutil.move(dl_path / member.path.lstrip('/'),
-                                downloaded_db)
-                    break
-        # Clean up
-        shutil.rmtree(dl_path, ignore_errors=True)
-
-        if downloaded_db.exists():
+        os.makedirs(config.data_dir or ".", exist_ok=True)
+
+        # Extract the games database while streaming the tar file
+        with requests.get(ETI_SYNC_SERVER_DOWNLOAD_URL,
+                          allow_redirects=True,
+                          stream=True,
+                          timeout=REQUEST_TIMEOUT_SECONDS) as response:
+            response.raw.decode_content = True
+            with tarfile.open(fileobj=response.raw, mode="r|") as tar:
+                for member in tar:
+                    if member.isfile() and member.name.endswith(LOCAL_DB_NAME):
+                        with open(partial_db, "wb") as f:
+                            shutil.copyfileobj(tar.extractfile(member), f,
+                                               DOWNLOAD_CHUNK_SIZE)
+                        os.replace(partial_db, downloaded_db)
+                        break
+
+        if os.path.exists(downloaded_db):
             logging.info(
                 f"Initial game database downloaded to {downloaded_db}")
         else:
@@ -329,6 +443,10 @@ def download_initial_game_db(config: Configuration) -> None:
     except tarfile.TarError as e:
         logging.error(f"Error extracting tar file: {e}")
         raise
+    finally:
+        # Drop the rest of a failed or aborted extraction
+        with contextlib.suppress(OSError):
+            os.unlink(partial_db)
 
 
 if __name__ == "__main__":